@@ -3,6 +3,7 @@
 from subprocess import Popen, run
 
 from pandora.default import get_homedir
+from pandora.storage_client import Storage
 
 
 def main() -> None:
@@ -16,6 +17,9 @@ def main() -> None:
         print('Failed to start the backend, exiting.')
         return
     print('done.')
+    print('Migrate the storage...')
+    Storage().migrate_users()
+    print('done.')
     print('Start unoserver...')
     Popen(['unoserver_launcher'])
     print('done.')
@@ -38,7 +38,7 @@ from unoserver.client import UnoClient  # type: ignore[import-untyped]
 
 from .default import get_config
 from .exceptions import Unsupported, NoPreview, InvalidPandoraObject
-from .helpers import make_bool, make_bool_for_redis
+from .helpers import make_bool
 from .storage_client import Storage
 from .text_parser import TextParser
 
@@ -426,7 +426,7 @@ class File:
             'mime_type': self.mime_type,
             'original_filename': self.original_filename,
             'save_date': self.save_date.isoformat(),
-            'deleted': make_bool_for_redis(self.deleted)
+            'deleted': int(self.deleted)
         }
 
     @property
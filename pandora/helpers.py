@@ -2,14 +2,15 @@
 
 from __future__ import annotations
 
+import json
 import logging
-import re
+import os
 import secrets
 
-from datetime import timedelta
 from enum import IntEnum, Enum, unique, auto
 from functools import lru_cache
 from importlib.metadata import version
+from pathlib import Path
 from typing import Any
 
 from publicsuffix2 import PublicSuffixList, fetch  # type: ignore[import-untyped]
@@ -21,9 +22,50 @@ from .default import get_homedir, get_socket_path
 from .exceptions import Unsupported, ConfigError
 from .role import Role
 
+try:
+    from yaml import CSafeLoader as _YAMLLoader
+except ImportError:
+    # PyYAML built without libyaml
+    from yaml import SafeLoader as _YAMLLoader  # type: ignore[assignment]
+
 logger = logging.getLogger('Helpers')
 
 
+def _load_yaml(path: Path) -> Any:
+    """Parse a YAML file, the result is stored as JSON in the cache directory and reused until the file changes.
+    NOTE: only use it for files without secrets (no API keys, passwords, ...)."""
+    stat = path.stat()
+    source = [stat.st_mtime_ns, stat.st_size]
+    # Not in the cache directory: it is shared with the redis cache (and its container).
+    cache_path = get_homedir() / 'config' / '.yaml_cache' / f'{path.name}.json'
+    try:
+        with cache_path.open() as f:
+            cached = json.load(f)
+        if cached['source'] == source:
+            return cached['content']
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        # Unreadable or invalid cache file, parse the YAML file again
+        logger.debug(f'Unable to use the cached YAML file {cache_path}: {e}')
+
+    with path.open() as f:
+        parsed = yaml.load(f, Loader=_YAMLLoader)
+    try:
+        dumped = json.dumps({'source': source, 'content': parsed})
+        # Only cache plain data, JSON would alter YAML specific types (dates, non-string keys, ...)
+        if json.loads(dumped)['content'] == parsed:
+            cache_path.parent.mkdir(mode=0o700, exist_ok=True)
+            # Write in a temporary file first, other processes may read the cache at the same time.
+            tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                f.write(dumped)
+            tmp_path.replace(cache_path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f'Unable to cache the parsed YAML file {path}: {e}')
+    return parsed
+
+
 # NOTE: Status code order for the UI: ALERT -> WARN -> CLEAN
 #       the keys in the enum must stay in this order
 @unique
@@ -57,23 +99,21 @@ class TypeObservable(Enum):
 def email_blocklist() -> list[str]:
     _path = get_homedir() / 'config' / 'email_blocklist.yml'
     if _path.exists():
-        with _path.open() as config_file:
-            config = yaml.safe_load(config_file.read())
+        config = _load_yaml(_path)
         return config['blocklist']
     return []
 
 
 @lru_cache(64)
 def allowlist_default() -> list[str]:
-    with (get_homedir() / 'config' / 'allowlist.yml').open() as config_file:
-        config = yaml.safe_load(config_file.read())
+    config = _load_yaml(get_homedir() / 'config' / 'allowlist.yml')
     return config['allowlist']
 
 
 @lru_cache(64)
 def roles_from_config() -> dict[str, Role]:
-    with (get_homedir() / 'config' / 'roles.yml').open() as config_file:
-        config = yaml.safe_load(config_file.read())
+    # NOTE: the Role objects hold the storage client, only the parsed file is cached.
+    config = _load_yaml(get_homedir() / 'config' / 'roles.yml')
     to_return = {}
     for r in config['roles']:
         actions = {key[4:]: value for key, value in r.items() if key.startswith('can_')}
@@ -88,13 +128,13 @@ def workers() -> dict[str, dict[str, Any]]:
     # Sample config file
     worker_sample_default_config_file = workers_dir / 'base.yml.sample'
     with worker_sample_default_config_file.open() as f:
-        default_sample_config = yaml.safe_load(f.read())
+        default_sample_config = yaml.load(f, Loader=_YAMLLoader)
 
     worker_default_config_file = workers_dir / 'base.yml'
     if worker_default_config_file.exists():
         # load default parameters
         with worker_default_config_file.open() as f:
-            default_config = yaml.safe_load(f.read())
+            default_config = yaml.load(f, Loader=_YAMLLoader)
     else:
         logger.warning(f'Workers config file ({worker_default_config_file}) does not exists, falling back to default.')
         default_config = {}
@@ -120,11 +160,11 @@ def workers() -> dict[str, dict[str, Any]]:
             raise ConfigError(f'No sample config file available for {configfile}, unable to load default config. Did you rename the yml.sample file instead of copying it? Please restore it.')
 
         with configfile.open() as f:
-            module_config = yaml.safe_load(f.read())
+            module_config = yaml.load(f, Loader=_YAMLLoader)
 
         # get the default config from the sample file, as a fallback
         with sample_config_file.open() as f:
-            module_config_sample = yaml.safe_load(f.read())
+            module_config_sample = yaml.load(f, Loader=_YAMLLoader)
 
         all_configs[configfile.stem] = {
             'meta': {**default_sample_config['meta'], **default_config.get('meta', {}),
@@ -146,18 +186,19 @@ def workers() -> dict[str, dict[str, Any]]:
     return {name: all_configs[name] for name in sorted(all_configs)}
 
 
+# Values considered as True, allocated once (True == 1, so it only holds True and '1')
+_TRUE_VALUES = frozenset((True, 1, '1'))
+
+
 def make_bool(value: bool | int | str | None) -> bool:
-    if value in [True, 1, '1']:
-        return True
-    return False
+    return value in _TRUE_VALUES
 
 
-def make_bool_for_redis(value: bool | None) -> int:
-    if value is True:
-        return 1
-    return 0
+# Multiplier to get seconds out of the unit suffix of a time value
+_TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
 
 
+@lru_cache(64)
 def expire_in_sec(time: str | int | None) -> int:
     """
     Try to parse time value and return the amount of seconds.
@@ -166,18 +207,14 @@ def expire_in_sec(time: str | int | None) -> int:
     """
     if not time:
         return 0
-    t_match = re.fullmatch(r'(\d+)([smhd]?)', str(time))
-    if t_match is None:
+    value = time if isinstance(time, str) else str(time)
+    if value[-1] in _TIME_UNITS:
+        number, unit = value[:-1], value[-1]
+    else:
+        number, unit = value, 's'
+    if not number.isdecimal():
         raise Unsupported(f"impossible to parse cache '{time}'")
-    if not t_match.group(2) or t_match.group(2) == 's':
-        return int(timedelta(seconds=int(t_match.group(1))).total_seconds())
-    if t_match.group(2) == 'm':
-        return int(timedelta(minutes=int(t_match.group(1))).total_seconds())
-    if t_match.group(2) == 'h':
-        return int(timedelta(hours=int(t_match.group(1))).total_seconds())
-    if t_match.group(2) == 'd':
-        return int(timedelta(days=int(t_match.group(1))).total_seconds())
-    return 0
+    return int(number) * _TIME_UNITS[unit]
 
 
 @lru_cache(64)
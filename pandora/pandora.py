@@ -62,9 +62,9 @@ class Pandora():
             return User(**u)
         return None
 
-    def get_users(self) -> list[User]:
+    def get_users(self, *, offset: int=0, limit: int | None=None) -> list[User]:
         users = []
-        for user in self.storage.get_users():
+        for user in self.storage.get_users(offset=offset, limit=limit):
             users.append(User(**user))
         return users
 
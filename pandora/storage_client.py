@@ -2,15 +2,48 @@
 
 from __future__ import annotations
 
-import operator
+import json
 
 from datetime import datetime
-from typing import overload
+from itertools import islice
+from typing import Iterable, overload
 
 from redis import ConnectionPool, Redis
+from redis.commands.core import Script
 
 from .default import get_config
 
+# Fetch all the observables of a task in a single call.
+# KEYS[1]: the observables set of the task.
+# Returns a list of [field, value, ...], the observables that are gone are skipped.
+_GET_TASK_OBSERVABLES = """
+local out = {}
+for _, id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    local observable = redis.call('HGETALL', 'observables:' .. id)
+    if #observable > 0 then
+        out[#out + 1] = observable
+    end
+end
+return out
+"""
+
+
+# Store an observable and index it, atomically and in a single call.
+# KEYS[1]: the observable hash, KEYS[2]: the observables index,
+# ARGV[1]: score in the index, ARGV[2]: identifier, ARGV[3...]: field, value, ...
+# The warninglist field is the old way to store WLs, HDEL is a no-op if it is missing.
+_SET_OBSERVABLE = """
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('HDEL', KEYS[1], 'warninglist')
+redis.call('ZADD', KEYS[2], ARGV[1], ARGV[2])
+return 1
+"""
+
+
+def _observable_identifier(sha256: str, observable_type: str) -> str:
+    # Member of the observables indexes, the hash is at observables:{identifier}
+    return f'{sha256}-{observable_type}'
+
 
 class Storage():
 
@@ -23,42 +56,110 @@ class Storage():
                 host=get_config('generic', 'storage_db_hostname'),
                 port=get_config('generic', 'storage_db_port'),
                 decode_responses=True)
+            # Used for the JSON blobs, json.loads takes bytes directly, no need to decode them first.
+            cls._redis_pool_storage_bytes: ConnectionPool = ConnectionPool(
+                host=get_config('generic', 'storage_db_hostname'),
+                port=get_config('generic', 'storage_db_port'))
+            cls._session_expire: int = int(get_config('generic', 'session_expire'))
+            # The clients are thread safe, no need to create new ones on each call.
+            client = Redis(connection_pool=cls._instance._redis_pool_storage)
+            cls._redis: Redis = client  # type: ignore[type-arg]
+            cls._redis_bytes: Redis = Redis(connection_pool=cls._instance._redis_pool_storage_bytes)  # type: ignore[type-arg]
+            # register_script caches the SHA, subsequent calls use EVALSHA
+            cls._get_task_observables: Script = client.register_script(_GET_TASK_OBSERVABLES)
+            cls._set_observable: Script = client.register_script(_SET_OBSERVABLE)
         return cls._instance
 
     @property
     def storage(self) -> Redis:  # type: ignore[type-arg]
-        return Redis(connection_pool=self._redis_pool_storage)
+        return self._redis
+
+    @property
+    def storage_bytes(self) -> Redis:  # type: ignore[type-arg]
+        return self._redis_bytes
+
+    def _batched_hgetall(self, ids: Iterable[str], prefix: str, chunk: int=500) -> list[dict[str, str]]:
+        # Flush the pipeline every chunk keys, the replies of a big index are not buffered all at once
+        hashes: list[dict[str, str]] = []
+        it = iter(ids)
+        while batch := list(islice(it, chunk)):
+            pipe = self.storage.pipeline(transaction=False)
+            for _id in batch:
+                pipe.hgetall(f'{prefix}:{_id}')
+            hashes.extend(pipe.execute())
+        return hashes
 
     # #### User ####
 
     def get_user(self, user_id: str) -> dict[str, str] | None:
-        return self.storage.hgetall(f'users:{user_id}')
+        # The users are stored as JSON blobs: one value to decode instead of a hash
+        if user := self.storage_bytes.get(f'users:{user_id}'):
+            return json.loads(user)
+        return None
 
     def set_user(self, user: dict[str, str]) -> None:
-        self.storage.hmset(f'users:{user["session_id"]}', user)  # type: ignore[arg-type]
-        self.storage.expire(f'users:{user["session_id"]}', get_config('generic', 'session_expire'))
-        self.storage.sadd('users', user["session_id"])
-
-    def get_users(self) -> list[dict[str, str]]:
-        users = []
+        timestamp = datetime.fromisoformat(user['last_seen']).timestamp()
+        with self.storage.pipeline(transaction=False) as pipe:
+            pipe.set(f'users:{user["session_id"]}', json.dumps(user), ex=self._session_expire)
+            pipe.zadd('users', {user["session_id"]: timestamp})
+            pipe.execute()
+
+    def get_users(self, *, offset: int=0, limit: int | None=None) -> list[dict[str, str]]:
+        users: list[dict[str, str]] = []
         to_pop = []
-        for session_id in self.storage.smembers('users'):
-            user = self.storage.hgetall(f'users:{session_id}')
+        if limit == 0:
+            return users
+        # The index is sorted by last_seen, most recent first
+        session_ids = self.storage.zrevrange('users', offset, offset + limit - 1 if limit is not None else -1)
+        if not session_ids:
+            return users
+        for session_id, user in zip(session_ids, self.storage_bytes.mget(f'users:{session_id}' for session_id in session_ids)):
             if user:
-                users.append(user)
+                users.append(json.loads(user))
             else:
                 # Session expired
                 to_pop.append(session_id)
         if to_pop:
-            self.storage.srem('users', *to_pop)
-        users.sort(key=operator.itemgetter('last_seen'), reverse=True)
+            self.storage.zrem('users', *to_pop)
         return users
 
     def del_users(self) -> None:
-        to_delete = [f'users:{key}' for key in self.storage.smembers('users')]
+        to_delete = [f'users:{key}' for key in self.storage.zrange('users', 0, -1)]
         to_delete.append('users')
         self.storage.delete(*to_delete)
 
+    def migrate_users(self) -> None:
+        # Must run before anything else uses the storage, called by bin/start.py.
+        # The users index used to be a set, it is now a sorted set scored by last_seen.
+        if self.storage.type('users') == 'set':
+            scores = {}
+            for session_id in self.storage.smembers('users'):
+                last_seen = self.storage.hget(f'users:{session_id}', 'last_seen')
+                if last_seen:
+                    scores[session_id] = datetime.fromisoformat(last_seen).timestamp()
+            with self.storage.pipeline() as pipe:
+                pipe.delete('users')
+                if scores:
+                    pipe.zadd('users', scores)
+                pipe.execute()
+
+        # The users used to be stored in hashes, they are now JSON blobs.
+        session_ids = self.storage.zrange('users', 0, -1)
+        pipe = self.storage.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.type(f'users:{session_id}')
+        for session_id, key_type in zip(session_ids, pipe.execute()):
+            if key_type != 'hash':
+                continue
+            key = f'users:{session_id}'
+            user = self.storage.hgetall(key)
+            ttl = self.storage.ttl(key)
+            with self.storage.pipeline() as migrate_pipe:
+                migrate_pipe.delete(key)
+                if ttl > 0:
+                    migrate_pipe.set(key, json.dumps(user), ex=ttl)
+                migrate_pipe.execute()
+
     # ##############
 
     # #### Role ####
@@ -67,14 +168,13 @@ class Storage():
         return self.storage.hgetall(f'roles:{role_name}')
 
     def get_roles(self) -> list[dict[str, str]]:
-        roles = []
-        for role_name in sorted(list(self.storage.smembers('roles'))):
-            roles.append(self.get_role(role_name))
-        return roles
+        return self._batched_hgetall(sorted(self.storage.smembers('roles')), 'roles')
 
     def set_role(self, role: dict[str, str]) -> None:
-        self.storage.hmset(f'roles:{role["name"]}', role)  # type: ignore[arg-type]
-        self.storage.sadd('roles', role["name"])
+        with self.storage.pipeline(transaction=False) as pipe:
+            pipe.hset(f'roles:{role["name"]}', mapping=role)
+            pipe.sadd('roles', role["name"])
+            pipe.execute()
 
     def has_roles(self) -> bool:
         return bool(self.storage.exists('roles'))
@@ -85,15 +185,12 @@ class Storage():
 
     def set_observable(self, observable: dict[str, str]) -> None:
         timestamp = datetime.fromisoformat(observable['last_seen']).timestamp()
-        identifier = f'{observable["sha256"]}-{observable["observable_type"]}'
+        identifier = _observable_identifier(observable['sha256'], observable['observable_type'])
 
-        self.storage.hmset(f'observables:{identifier}', observable)  # type: ignore[arg-type]
-        if self.storage.hexists(f'observables:{identifier}', 'warninglist'):
-            # Clear old way to store WLs
-            self.storage.hdel(f'observables:{identifier}', 'warninglist')
-        # TODO: use that in search page for observables.
+        # TODO: use the observables index in search page for observables.
         # Note: scan doesn't return the entries in any order, so we need to paginate manually
-        self.storage.zadd('observables', {identifier: timestamp})
+        self._set_observable(keys=[f'observables:{identifier}', 'observables'],
+                             args=[timestamp, identifier, *(v for field_value in observable.items() for v in field_value)])
 
     @overload
     def get_observable(self, sha256: str, observable_type: str) -> dict[str, str] | None:
@@ -107,19 +204,17 @@ class Storage():
                        observable_type: str | None =None,
                        identifier: str | None=None) -> dict[str, str] | None:
         if not identifier:
-            identifier = f'{sha256}-{observable_type}'
+            if sha256 is None or observable_type is None:
+                raise TypeError('get_observable needs an identifier, or a sha256 and an observable_type')
+            identifier = _observable_identifier(sha256, observable_type)
         return self.storage.hgetall(f'observables:{identifier}')
 
     def get_task_observables(self, task_uuid: str) -> list[dict[str, str]]:
-        observables = []
-        for identifier in self.storage.smembers(f'{task_uuid}:observables'):
-            observable = self.get_observable(identifier=identifier)
-            if observable:
-                observables.append(observable)
-        return observables
+        return [dict(zip(flat[::2], flat[1::2]))
+                for flat in self._get_task_observables(keys=[f'{task_uuid}:observables'])]
 
     def add_task_observable(self, task_uuid: str, sha256: str, observable_type: str) -> None:
-        self.storage.sadd(f'{task_uuid}:observables', f'{sha256}-{observable_type}')
+        self.storage.sadd(f'{task_uuid}:observables', _observable_identifier(sha256, observable_type))
 
     # #### Observables lists ####
 
@@ -127,7 +222,13 @@ class Storage():
         return self.storage.hgetall('suspicious_observables')
 
     def add_suspicious_observable(self, observable: str, observable_type: str) -> None:
-        self.storage.hset('suspicious_observables', observable.strip(), observable_type.strip())
+        self.add_suspicious_observables({observable: observable_type})
+
+    def add_suspicious_observables(self, observables: dict[str, str]) -> None:
+        if not observables:
+            return
+        self.storage.hset('suspicious_observables',
+                          mapping={observable.strip(): observable_type.strip() for observable, observable_type in observables.items()})
 
     def delete_suspicious_observable(self, observable: str) -> None:
         self.storage.hdel('suspicious_observables', observable.strip())
@@ -136,7 +237,13 @@ class Storage():
         return self.storage.hgetall('legitimate_observables')
 
     def add_legitimate_observable(self, observable: str, observable_type: str) -> None:
-        self.storage.hset('legitimate_observables', observable.strip(), observable_type.strip())
+        self.add_legitimate_observables({observable: observable_type})
+
+    def add_legitimate_observables(self, observables: dict[str, str]) -> None:
+        if not observables:
+            return
+        self.storage.hset('legitimate_observables',
+                          mapping={observable.strip(): observable_type.strip() for observable, observable_type in observables.items()})
 
     def delete_legitimate_observable(self, observable: str) -> None:
         self.storage.hdel('legitimate_observables', observable.strip())
@@ -149,14 +256,13 @@ class Storage():
         return self.storage.hgetall(f'files:{file_id}')
 
     def set_file(self, file_details: dict[str, str | int]) -> None:
-        self.storage.hmset(f'files:{file_details["uuid"]}', file_details)  # type: ignore[arg-type]
-        self.storage.sadd('files', file_details["uuid"])
+        with self.storage.pipeline(transaction=False) as pipe:
+            pipe.hset(f'files:{file_details["uuid"]}', mapping=file_details)
+            pipe.sadd('files', file_details["uuid"])
+            pipe.execute()
 
     def get_files(self) -> list[dict[str, str]]:
-        files = []
-        for uuid in self.storage.smembers('files'):
-            files.append(self.get_file(uuid))
-        return files
+        return self._batched_hgetall(self.storage.smembers('files'), 'files')
 
     # ##############
 
@@ -167,15 +273,20 @@ class Storage():
 
     def set_task(self, task: dict[str, str]) -> None:
         timestamp = datetime.fromisoformat(task['save_date']).timestamp()
-        self.storage.hmset(f'tasks:{task["uuid"]}', task)  # type: ignore[arg-type]
-        self.storage.zadd('tasks', {task["uuid"]: timestamp})
-
-    def get_tasks(self, *, first_date: str | float=0, last_date: str | float='+Inf') -> list[dict[str, str]]:
-        tasks = []
-        for uuid in self.storage.zrevrangebyscore('tasks', min=first_date, max=last_date):
-            tasks.append(self.get_task(uuid))
-        tasks.sort(key=operator.itemgetter('save_date'), reverse=True)
-        return tasks
+        with self.storage.pipeline(transaction=False) as pipe:
+            pipe.hset(f'tasks:{task["uuid"]}', mapping=task)
+            pipe.zadd('tasks', {task["uuid"]: timestamp})
+            pipe.execute()
+
+    def get_tasks(self, *, first_date: str | float=0, last_date: str | float='+Inf',
+                  offset: int=0, limit: int | None=None) -> list[dict[str, str]]:
+        # The index is sorted by save_date, zrevrangebyscore returns the most recent first
+        if offset or limit is not None:
+            uuids = self.storage.zrevrangebyscore('tasks', min=first_date, max=last_date,
+                                                  start=offset, num=limit if limit is not None else -1)
+        else:
+            uuids = self.storage.zrevrangebyscore('tasks', min=first_date, max=last_date)
+        return self._batched_hgetall(uuids, 'tasks')
 
     def count_tasks(self, *, first_date: str | float=0, last_date: str | float='+Inf') -> int:
         return self.storage.zcount('tasks', min=first_date, max=last_date)
@@ -194,6 +305,8 @@ class Storage():
         return self.storage.hgetall(f'reports:{task_uuid}-{worker_name}')
 
     def set_report(self, report: dict[str, str]) -> None:
-        self.storage.hmset(f'reports:{report["task_uuid"]}-{report["worker_name"]}', report)  # type: ignore[arg-type]
-        # In case the status of the task was set, drop it
-        self.storage.hdel(f'tasks:{report["task_uuid"]}', 'status')
+        with self.storage.pipeline(transaction=False) as pipe:
+            pipe.hset(f'reports:{report["task_uuid"]}-{report["worker_name"]}', mapping=report)
+            # In case the status of the task was set, drop it
+            pipe.hdel(f'tasks:{report["task_uuid"]}', 'status')
+            pipe.execute()